@@ -10,6 +10,7 @@ from opentelemetry import trace, metrics
 from services.external_service import ExternalAPIService
 from services.nlp_service import NLPService
 from utils.correlation_context import CorrelationContext
+from utils.telemetry_common import TRACE_RESPONSE_SIZE, ERROR_STATUS, metric_labels
 from models.request_models import ChatbotResponse
 
 class ChatbotService:
@@ -21,6 +22,25 @@ class ChatbotService:
         self.external_service = ExternalAPIService()
         self.nlp_service = NLPService()
         
+        # External data fetchers keyed by intent; intents not listed need no external data
+        self._external_fetchers = {
+            "weather": self.external_service.get_weather_data,
+            "news": self.external_service.get_news_data,
+            "stock_price": self.external_service.get_stock_data
+        }
+        
+        # Response templates: constant strings for static intents, formatters for data-backed ones
+        self._static_responses = {
+            "greeting": "Hello! How can I help you today?",
+            "goodbye": "Goodbye! Have a great day!",
+            None: "I understand you're asking about something, but I need more information to help you properly."
+        }
+        self._response_fmts = {
+            "weather": lambda d: f"The weather is {d.get('condition', 'unknown')} with temperature {d.get('temperature', 'N/A')}°C",
+            "news": lambda d: f"Here's the latest news: {d.get('headline', 'No news available')}",
+            "stock_price": lambda d: f"The stock price is ${d.get('price', 'N/A')}"
+        }
+        
         # Create custom metrics
         self.message_processing_counter = self.meter.create_counter(
             name="chatbot_messages_processed_total",
@@ -48,19 +68,27 @@ class ChatbotService:
     ) -> ChatbotResponse:
         """Process a chatbot message with comprehensive telemetry"""
         
-        with self.tracer.start_as_current_span("chatbot_process_message") as span:
-            start_time = time.time()
+        # Failures are recorded explicitly below, so the context manager must not record them again
+        with self.tracer.start_as_current_span(
+            "chatbot_process_message", record_exception=False, set_status_on_exception=False
+        ) as span:
+            rec = span.is_recording()
+            start_ns = time.monotonic_ns()
             
             try:
-                # Set span attributes
-                span.set_attribute("request_id", correlation_ctx.request_id)
-                span.set_attribute("user_id", user_id or "anonymous")
-                span.set_attribute("message_length", len(message))
-                span.set_attribute("service", "chatbot")
-                
-                span.add_event("Starting message processing", {
-                    "message_preview": message[:50] + "..." if len(message) > 50 else message
-                })
+                # Set span attributes (skipped entirely when the span is sampled out).
+                # request_id lives on this root span only; children correlate through the trace id.
+                if rec:
+                    span.set_attributes({
+                        "request_id": correlation_ctx.request_id,
+                        "user_id": user_id or "anonymous",
+                        "message_length": len(message),
+                        "service": "chatbot"
+                    })
+                    
+                    span.add_event("Starting message processing", {
+                        "message_preview": message[:50] + "..." if len(message) > 50 else message
+                    })
                 
                 # Step 1: Validate and preprocess message
                 await self._validate_message(message, span, correlation_ctx)
@@ -79,26 +107,30 @@ class ChatbotService:
                 )
                 
                 # Record metrics
-                processing_time = time.time() - start_time
-                self.processing_duration.record(processing_time, {
-                    "intent": analysis_result.get("intent", "unknown"),
-                    "user_type": "registered" if user_id else "anonymous"
-                })
+                processing_ns = time.monotonic_ns() - start_ns
+                intent = analysis_result.get("intent", "unknown")
+                self.processing_duration.record(processing_ns / 1e9, metric_labels(
+                    "intent", intent,
+                    "user_type", "registered" if user_id else "anonymous"
+                ))
                 
-                self.message_processing_counter.add(1, {
-                    "intent": analysis_result.get("intent", "unknown"),
-                    "success": "true"
-                })
+                self.message_processing_counter.add(1, metric_labels(
+                    "intent", intent,
+                    "success", "true"
+                ))
                 
-                self.intent_recognition_counter.add(1, {
-                    "intent": analysis_result.get("intent", "unknown"),
-                    "confidence": analysis_result.get("confidence_level", "low")
-                })
+                self.intent_recognition_counter.add(1, metric_labels(
+                    "intent", intent,
+                    "confidence", analysis_result.get("confidence_level", "low")
+                ))
                 
-                span.set_attribute("processing_time_ms", processing_time * 1000)
-                span.set_attribute("intent", analysis_result.get("intent", "unknown"))
-                span.set_attribute("confidence", analysis_result.get("confidence", 0.0))
-                span.add_event("Message processing completed successfully")
+                if rec:
+                    span.set_attributes({
+                        "processing_time_ms": processing_ns // 1_000_000,
+                        "intent": intent,
+                        "confidence": analysis_result.get("confidence", 0.0)
+                    })
+                    span.add_event("Message processing completed successfully")
                 
                 return ChatbotResponse(
                     response=response,
@@ -109,85 +141,108 @@ class ChatbotService:
                 
             except Exception as e:
                 # Record failure metrics
-                self.message_processing_counter.add(1, {
-                    "intent": "unknown",
-                    "success": "false"
-                })
+                self.message_processing_counter.add(1, metric_labels(
+                    "intent", "unknown",
+                    "success", "false"
+                ))
                 
+                # record_exception already captures the exception type and message
                 span.record_exception(e)
-                span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
-                span.add_event("Message processing failed", {
-                    "error_type": type(e).__name__,
-                    "error_message": str(e)
-                })
+                span.set_status(ERROR_STATUS)
                 raise
     
     async def _validate_message(self, message: str, parent_span, correlation_ctx: CorrelationContext):
         """Validate incoming message"""
-        with self.tracer.start_as_current_span("validate_message", parent=parent_span) as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.add_event("Validating message")
+        # Leaf span: parented explicitly instead of made current, so no context attach/detach
+        span = self.tracer.start_span("validate_message", context=trace.set_span_in_context(parent_span))
+        try:
+            rec = span.is_recording()
+            if rec:
+                span.add_event("Validating message")
             
-            if not message or len(message.strip()) == 0:
+            # Empty check first (also rejects None), then the length gate, so oversized
+            # whitespace-only input never reaches isspace()
+            if not message:
                 error_msg = "Empty message provided"
-                span.add_event("Validation failed", {"reason": error_msg})
+                if rec:
+                    span.add_event("Validation failed", {"reason": error_msg})
                 raise ValueError(error_msg)
             
             if len(message) > 5000:
                 error_msg = "Message too long"
-                span.add_event("Validation failed", {"reason": error_msg})
+                if rec:
+                    span.add_event("Validation failed", {"reason": error_msg})
+                raise ValueError(error_msg)
+            
+            if message.isspace():
+                error_msg = "Empty message provided"
+                if rec:
+                    span.add_event("Validation failed", {"reason": error_msg})
                 raise ValueError(error_msg)
             
             # Simulate some processing time
             await asyncio.sleep(0.001)
             
-            span.add_event("Message validation completed")
+            if rec:
+                span.add_event("Message validation completed")
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(ERROR_STATUS)
+            raise
+        finally:
+            span.end()
     
     async def _analyze_message(self, message: str, parent_span, correlation_ctx: CorrelationContext) -> dict:
         """Analyze message for intent and entities"""
-        with self.tracer.start_as_current_span("analyze_message", parent=parent_span) as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.add_event("Starting message analysis")
+        with self.tracer.start_as_current_span("analyze_message", context=trace.set_span_in_context(parent_span)) as span:
+            rec = span.is_recording()
+            if rec:
+                span.add_event("Starting message analysis")
             
             # Use NLP service for analysis
             analysis_result = await self.nlp_service.analyze_intent(message, correlation_ctx)
             
-            span.set_attribute("detected_intent", analysis_result.get("intent", "unknown"))
-            span.set_attribute("confidence_score", analysis_result.get("confidence", 0.0))
-            span.set_attribute("entities_count", len(analysis_result.get("entities", [])))
-            
-            span.add_event("Message analysis completed", {
-                "intent": analysis_result.get("intent"),
-                "confidence": analysis_result.get("confidence"),
-                "entities_found": len(analysis_result.get("entities", []))
-            })
+            if rec:
+                span.set_attributes({
+                    "detected_intent": analysis_result.get("intent", "unknown"),
+                    "confidence_score": analysis_result.get("confidence", 0.0),
+                    "entities_count": len(analysis_result.get("entities", []))
+                })
+                
+                span.add_event("Message analysis completed", {
+                    "intent": analysis_result.get("intent"),
+                    "confidence": analysis_result.get("confidence"),
+                    "entities_found": len(analysis_result.get("entities", []))
+                })
             
             return analysis_result
     
     async def _fetch_external_data(self, analysis_result: dict, parent_span, correlation_ctx: CorrelationContext) -> dict:
         """Fetch external data based on analysis"""
-        with self.tracer.start_as_current_span("fetch_external_data", parent=parent_span) as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.set_attribute("intent", analysis_result.get("intent", "unknown"))
-            
+        with self.tracer.start_as_current_span("fetch_external_data", context=trace.set_span_in_context(parent_span)) as span:
+            rec = span.is_recording()
             intent = analysis_result.get("intent")
+            if rec:
+                span.set_attribute("intent", intent or "unknown")
+            
             external_data = {}
             
-            if intent in ["weather", "news", "stock_price"]:
-                span.add_event(f"Fetching external data for intent: {intent}")
+            fetcher = self._external_fetchers.get(intent)
+            if fetcher:
+                if rec:
+                    span.add_event("Fetching external data", {"intent": intent})
                 
-                # Make external API calls based on intent
-                if intent == "weather":
-                    external_data = await self.external_service.get_weather_data(correlation_ctx)
-                elif intent == "news":
-                    external_data = await self.external_service.get_news_data(correlation_ctx)
-                elif intent == "stock_price":
-                    external_data = await self.external_service.get_stock_data(correlation_ctx)
+                # Make external API call based on intent
+                external_data = await fetcher(correlation_ctx)
                 
-                span.add_event("External data fetch completed", {
-                    "data_size": len(str(external_data))
-                })
-            else:
+                if rec:
+                    if TRACE_RESPONSE_SIZE:
+                        span.add_event("External data fetch completed", {
+                            "data_size": len(external_data)
+                        })
+                    else:
+                        span.add_event("External data fetch completed")
+            elif rec:
                 span.add_event("No external data needed for this intent")
             
             return external_data
@@ -201,12 +256,17 @@ class ChatbotService:
         correlation_ctx: CorrelationContext
     ) -> str:
         """Generate chatbot response"""
-        with self.tracer.start_as_current_span("generate_response", parent=parent_span) as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.set_attribute("intent", analysis_result.get("intent", "unknown"))
-            span.set_attribute("has_external_data", len(external_data) > 0)
-            
-            span.add_event("Starting response generation")
+        # Leaf span: parented explicitly instead of made current, so no context attach/detach
+        span = self.tracer.start_span("generate_response", context=trace.set_span_in_context(parent_span))
+        try:
+            rec = span.is_recording()
+            if rec:
+                span.set_attributes({
+                    "intent": analysis_result.get("intent", "unknown"),
+                    "has_external_data": len(external_data) > 0
+                })
+                
+                span.add_event("Starting response generation")
             
             # Simulate response generation logic
             intent = analysis_result.get("intent", "general")
@@ -217,25 +277,27 @@ class ChatbotService:
             await asyncio.sleep(processing_time)
             
             # Generate response based on intent and external data
-            if intent == "weather" and external_data:
-                response = f"The weather is {external_data.get('condition', 'unknown')} with temperature {external_data.get('temperature', 'N/A')}°C"
-            elif intent == "news" and external_data:
-                response = f"Here's the latest news: {external_data.get('headline', 'No news available')}"
-            elif intent == "stock_price" and external_data:
-                response = f"The stock price is ${external_data.get('price', 'N/A')}"
-            elif intent == "greeting":
-                response = "Hello! How can I help you today?"
-            elif intent == "goodbye":
-                response = "Goodbye! Have a great day!"
+            fmt = self._response_fmts.get(intent)
+            if fmt is not None and external_data:
+                response = fmt(external_data)
             else:
-                response = "I understand you're asking about something, but I need more information to help you properly."
-            
-            span.set_attribute("response_length", len(response))
-            span.set_attribute("generation_time_ms", processing_time * 1000)
+                response = self._static_responses.get(intent, self._static_responses[None])
             
-            span.add_event("Response generation completed", {
-                "response_length": len(response),
-                "processing_time_ms": processing_time * 1000
-            })
+            if rec:
+                span.set_attributes({
+                    "response_length": len(response),
+                    "generation_time_ms": processing_time * 1000
+                })
+                
+                span.add_event("Response generation completed", {
+                    "response_length": len(response),
+                    "processing_time_ms": processing_time * 1000
+                })
             
-            return response
\ No newline at end of file
+            return response
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(ERROR_STATUS)
+            raise
+        finally:
+            span.end()
\ No newline at end of file
@@ -2,33 +2,33 @@
 Correlation context for tracking requests across the application
 """
 
+import sys
 import time
-from dataclasses import dataclass
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from typing import Optional, Dict, Any
 from opentelemetry import trace
 
-@dataclass
+# Slotted dataclasses need Python 3.10+; older interpreters fall back to a regular instance dict
+_DATACLASS_OPTIONS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+@dataclass(**_DATACLASS_OPTIONS)
 class CorrelationContext:
     """Context object to correlate logs, traces, and metrics across a request"""
     
     request_id: str
-    operation_id: Optional[int] = None
-    start_time: float = None
+    start_time: Optional[int] = None  # time.monotonic_ns() at request start
     user_id: Optional[str] = None
     session_id: Optional[str] = None
-    additional_properties: Optional[Dict[str, Any]] = None
+    additional_properties: Dict[str, Any] = field(default_factory=dict)
+    # Trace id of the request, resolved lazily by the operation_id property
+    _operation_id: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+    # Identifier fields for to_dict(), built once on first use
+    _base: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False, compare=False)
     
     def __post_init__(self):
         if self.start_time is None:
-            self.start_time = time.time()
-        
-        if self.operation_id is None:
-            current_span = trace.get_current_span()
-            if current_span and current_span.get_span_context():
-                self.operation_id = current_span.get_span_context().trace_id
-        
-        if self.additional_properties is None:
-            self.additional_properties = {}
+            self.start_time = time.monotonic_ns()
     
     def add_property(self, key: str, value: Any):
         """Add additional property to context"""
@@ -38,17 +38,37 @@ class CorrelationContext:
         """Get property from context"""
         return self.additional_properties.get(key, default)
     
+    @property
+    def operation_id(self) -> Optional[int]:
+        """Trace id for this request, looked up from the current span on first use"""
+        if self._operation_id is None:
+            span_context = trace.get_current_span().get_span_context()
+            if span_context.is_valid:
+                self._operation_id = span_context.trace_id
+        return self._operation_id
+    
     def get_elapsed_time(self) -> float:
-        """Get elapsed time since request start"""
-        return time.time() - self.start_time
+        """Get elapsed time since request start in seconds"""
+        return (time.monotonic_ns() - self.start_time) / 1e9
     
     def to_dict(self) -> dict:
         """Convert context to dictionary for logging"""
+        base = self._base
+        if base is None:
+            base = {
+                "request_id": self.request_id,
+                "operation_id": self.operation_id,
+                "user_id": self.user_id,
+                "session_id": self.session_id
+            }
+            # Keep retrying the trace id lookup until a span is active
+            if base["operation_id"] is not None:
+                self._base = base
         return {
-            "request_id": self.request_id,
-            "operation_id": self.operation_id,
-            "user_id": self.user_id,
-            "session_id": self.session_id,
+            **base,
             "elapsed_time_ms": self.get_elapsed_time() * 1000,
             **self.additional_properties
-        }
\ No newline at end of file
+        }
+
+# Correlation context of the request being handled in the current task; set by TelemetryMiddleware
+correlation_ctx_var: ContextVar[Optional[CorrelationContext]] = ContextVar("correlation_ctx", default=None)
\ No newline at end of file
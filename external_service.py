@@ -3,21 +3,62 @@ External API service with automatic dependency tracking via OpenTelemetry
 """
 
 import asyncio
+import importlib.util
+import os
 import time
 import random
 from typing import Dict, Any
 import httpx
-import requests
 from opentelemetry import trace, metrics
 from utils.correlation_context import CorrelationContext
+from utils.telemetry_common import TRACE_RESPONSE_SIZE, ERROR_STATUS, metric_labels
+
+# Real HTTP calls are opt-in; the demo simulates external APIs by default
+SIMULATE_EXTERNAL_APIS = os.getenv("SIMULATE_EXTERNAL_APIS", "1") == "1"
+
+# httpx only speaks HTTP/2 when the optional h2 package is installed
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Dedicated generator for the simulated API path
+_RNG = random.Random()
+
+_SIMULATED_ERRORS = (
+    "Connection timeout",
+    "Service unavailable",
+    "Rate limit exceeded",
+    "Invalid API key"
+)
+_WEATHER_CONDITIONS = ("sunny", "cloudy", "rainy", "snowy")
+_HEADLINES = (
+    "Tech stocks surge amid AI breakthrough",
+    "Climate summit reaches historic agreement",
+    "New medical discovery shows promise",
+    "Economic indicators point to growth"
+)
 
 class ExternalAPIService:
     """Service for making external API calls with comprehensive telemetry"""
     
+    # Health-check simulation parameters: (service, min delay s, max delay s, failure rate)
+    _SERVICES = (
+        ("weather_api", 0.05, 0.15, 0.10),
+        ("news_api", 0.03, 0.12, 0.05),
+        ("stock_api", 0.08, 0.20, 0.08)
+    )
+    # Same parameters transposed into one tuple per field
+    _SERVICE_NAMES, _MIN_DELAYS, _MAX_DELAYS, _FAIL_RATES = zip(*_SERVICES)
+    
     def __init__(self):
         self.tracer = trace.get_tracer(__name__)
         self.meter = metrics.get_meter(__name__)
         
+        # Long-lived pooled client shared by all outgoing calls
+        self._http = httpx.AsyncClient(
+            http2=_HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(5.0)
+        )
+        
         # Create custom metrics for dependencies
         self.dependency_calls_counter = self.meter.create_counter(
             name="external_dependency_calls_total",
@@ -36,29 +77,42 @@ class ExternalAPIService:
             description="Total number of external dependency errors",
             unit="1"
         )
+        
+        # Constant "External call started" event attributes per (service, url, params count)
+        self._event_attrs_cache: dict[tuple, dict] = {}
+    
+    async def aclose(self):
+        """Close the pooled HTTP client"""
+        await self._http.aclose()
     
     async def check_external_dependencies(self, correlation_ctx: CorrelationContext) -> Dict[str, Any]:
         """Check health of external dependencies"""
         with self.tracer.start_as_current_span("check_external_dependencies") as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
             span.add_event("Starting dependency health check")
             
-            # Check multiple services concurrently
-            tasks = [
-                self._check_weather_service(correlation_ctx),
-                self._check_news_service(correlation_ctx),
-                self._check_stock_service(correlation_ctx)
-            ]
+            # Simulate all health check calls at once: they run concurrently, so the
+            # whole check takes as long as the slowest one
+            delays = [_RNG.uniform(lo, hi) for lo, hi in zip(self._MIN_DELAYS, self._MAX_DELAYS)]
+            healthy = [_RNG.random() >= rate for rate in self._FAIL_RATES]
+            await asyncio.sleep(max(delays))
             
-            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for name, ok in zip(self._SERVICE_NAMES, healthy):
+                if not ok:
+                    span.add_event("Service health check failed", {"service_name": name})
+            weather_ok, news_ok, stock_ok = healthy
             
             health_status = {
-                "weather_service": not isinstance(results[0], Exception),
-                "news_service": not isinstance(results[1], Exception),
-                "stock_service": not isinstance(results[2], Exception)
+                "weather_service": weather_ok,
+                "news_service": news_ok,
+                "stock_service": stock_ok
             }
             
-            span.set_attribute("all_services_healthy", all(health_status.values()))
+            span.set_attributes({
+                "weather_healthy": weather_ok,
+                "news_healthy": news_ok,
+                "stock_healthy": stock_ok,
+                "all_services_healthy": weather_ok and news_ok and stock_ok
+            })
             span.add_event("Dependency health check completed", health_status)
             
             return health_status
@@ -96,68 +150,6 @@ class ExternalAPIService:
                 correlation_ctx
             )
     
-    async def _check_weather_service(self, correlation_ctx: CorrelationContext) -> bool:
-        """Check weather service health"""
-        with self.tracer.start_as_current_span("check_weather_service_health") as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.set_attribute("service_name", "weather_api")
-            
-            try:
-                # Simulate health check call
-                await asyncio.sleep(random.uniform(0.05, 0.15))
-                
-                # Simulate occasional failures
-                if random.random() < 0.1:  # 10% failure rate
-                    raise Exception("Weather service unavailable")
-                
-                span.add_event("Weather service health check passed")
-                return True
-                
-            except Exception as e:
-                span.record_exception(e)
-                span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
-                return False
-    
-    async def _check_news_service(self, correlation_ctx: CorrelationContext) -> bool:
-        """Check news service health"""
-        with self.tracer.start_as_current_span("check_news_service_health") as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.set_attribute("service_name", "news_api")
-            
-            try:
-                await asyncio.sleep(random.uniform(0.03, 0.12))
-                
-                if random.random() < 0.05:  # 5% failure rate
-                    raise Exception("News service unavailable")
-                
-                span.add_event("News service health check passed")
-                return True
-                
-            except Exception as e:
-                span.record_exception(e)
-                span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
-                return False
-    
-    async def _check_stock_service(self, correlation_ctx: CorrelationContext) -> bool:
-        """Check stock service health"""
-        with self.tracer.start_as_current_span("check_stock_service_health") as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.set_attribute("service_name", "stock_api")
-            
-            try:
-                await asyncio.sleep(random.uniform(0.08, 0.20))
-                
-                if random.random() < 0.08:  # 8% failure rate
-                    raise Exception("Stock service unavailable")
-                
-                span.add_event("Stock service health check passed")
-                return True
-                
-            except Exception as e:
-                span.record_exception(e)
-                span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
-                return False
-    
     async def _make_external_call(
         self,
         service_name: str,
@@ -167,84 +159,109 @@ class ExternalAPIService:
         correlation_ctx: CorrelationContext
     ) -> Dict[str, Any]:
         """Make external API call with comprehensive telemetry"""
-        start_time = time.time()
+        start_ns = time.monotonic_ns()
+        rec = span.is_recording()
         
         # Set span attributes for dependency
-        span.set_attribute("request_id", correlation_ctx.request_id)
-        span.set_attribute("http.method", "GET")
-        span.set_attribute("http.url", url)
-        span.set_attribute("service.name", service_name)
-        span.set_attribute("dependency.type", "http")
+        if rec:
+            span.set_attributes({
+                "http.method": "GET",
+                "http.url": url,
+                "service.name": service_name,
+                "dependency.type": "http"
+            })
         
         try:
-            span.add_event(f"Starting external call to {service_name}", {
-                "url": url,
-                "params_count": len(params)
-            })
+            if rec:
+                key = (service_name, url, len(params))
+                start_attrs = self._event_attrs_cache.get(key)
+                if start_attrs is None:
+                    start_attrs = self._event_attrs_cache[key] = {
+                        "service": service_name,
+                        "url": url,
+                        "params_count": len(params)
+                    }
+                span.add_event("External call started", start_attrs)
             
-            # For demo purposes, we'll simulate the API calls instead of making real ones
-            # In production, these would be actual HTTP calls that are auto-instrumented
-            response_data = await self._simulate_api_call(service_name, url, params, span)
+            # For demo purposes, API calls are simulated unless SIMULATE_EXTERNAL_APIS=0;
+            # real calls go through the pooled client and are auto-instrumented
+            if SIMULATE_EXTERNAL_APIS:
+                response_data = await self._simulate_api_call(service_name, url, params, span)
+                status_code = 200
+            else:
+                resp = await self._http.get(url, params=params)
+                resp.raise_for_status()
+                response_data = resp.json()
+                status_code = resp.status_code
             
             # Calculate call duration
-            duration = time.time() - start_time
+            duration_ns = time.monotonic_ns() - start_ns
             
             # Record successful call metrics
-            self.dependency_calls_counter.add(1, {
-                "service": service_name,
-                "status": "success",
-                "method": "GET"
-            })
+            self.dependency_calls_counter.add(1, metric_labels(
+                "service", service_name,
+                "status", "success",
+                "method", "GET"
+            ))
             
-            self.dependency_duration.record(duration, {
-                "service": service_name,
-                "status": "success"
-            })
+            self.dependency_duration.record(duration_ns / 1e9, metric_labels(
+                "service", service_name,
+                "status", "success"
+            ))
             
             # Set success attributes
-            span.set_attribute("http.status_code", 200)
-            span.set_attribute("dependency.success", True)
-            span.set_attribute("dependency.duration_ms", duration * 1000)
-            span.set_attribute("response.size", len(str(response_data)))
-            
-            span.add_event(f"External call to {service_name} completed successfully", {
-                "duration_ms": duration * 1000,
-                "response_size": len(str(response_data))
-            })
+            if rec:
+                span_attrs = {
+                    "http.status_code": status_code,
+                    "dependency.success": True,
+                    "dependency.duration_ms": duration_ns // 1_000_000
+                }
+                event_attrs = {"service": service_name, "duration_ms": duration_ns // 1_000_000}
+                if TRACE_RESPONSE_SIZE:
+                    size_hint = len(response_data) if isinstance(response_data, dict) else 0
+                    span_attrs["response.size"] = size_hint
+                    event_attrs["response_size"] = size_hint
+                span.set_attributes(span_attrs)
+                
+                span.add_event("External call completed", event_attrs)
             
             return response_data
             
         except Exception as e:
-            duration = time.time() - start_time
+            duration_ns = time.monotonic_ns() - start_ns
             
             # Record failed call metrics
-            self.dependency_calls_counter.add(1, {
-                "service": service_name,
-                "status": "error",
-                "method": "GET"
-            })
+            self.dependency_calls_counter.add(1, metric_labels(
+                "service", service_name,
+                "status", "error",
+                "method", "GET"
+            ))
             
-            self.dependency_errors_counter.add(1, {
-                "service": service_name,
-                "error_type": type(e).__name__
-            })
+            self.dependency_errors_counter.add(1, metric_labels(
+                "service", service_name,
+                "error_type", type(e).__name__
+            ))
             
-            self.dependency_duration.record(duration, {
-                "service": service_name,
-                "status": "error"
-            })
+            self.dependency_duration.record(duration_ns / 1e9, metric_labels(
+                "service", service_name,
+                "status", "error"
+            ))
             
             # Set error attributes
-            span.set_attribute("dependency.success", False)
-            span.set_attribute("dependency.duration_ms", duration * 1000)
             span.record_exception(e)
-            span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
-            
-            span.add_event(f"External call to {service_name} failed", {
-                "error_type": type(e).__name__,
-                "error_message": str(e),
-                "duration_ms": duration * 1000
-            })
+            span.set_status(ERROR_STATUS)
+            if rec:
+                span.set_attributes({
+                    "dependency.success": False,
+                    "dependency.duration_ms": duration_ns // 1_000_000
+                })
+                
+                span.add_event("External call failed", {
+                    "service": service_name,
+                    "error_type": type(e).__name__,
+                    "error_message": str(e),
+                    "duration_ms": duration_ns // 1_000_000
+                })
             
             # Return empty data on failure for demo purposes
             return {}
@@ -259,43 +276,31 @@ class ExternalAPIService:
         """Simulate external API calls with realistic delays and occasional failures"""
         
         # Simulate network delay
-        delay = random.uniform(0.1, 0.8)
+        delay = _RNG.uniform(0.1, 0.8)
         await asyncio.sleep(delay)
         
         # Simulate occasional failures
         failure_rate = 0.15 if service_name == "stock_api" else 0.1
-        if random.random() < failure_rate:
-            error_types = [
-                "Connection timeout",
-                "Service unavailable",
-                "Rate limit exceeded",
-                "Invalid API key"
-            ]
-            raise Exception(f"{service_name}: {random.choice(error_types)}")
+        if _RNG.random() < failure_rate:
+            raise Exception(f"{service_name}: {_RNG.choice(_SIMULATED_ERRORS)}")
         
         # Return simulated response data
         if "weather" in service_name:
             return {
-                "condition": random.choice(["sunny", "cloudy", "rainy", "snowy"]),
-                "temperature": random.randint(-10, 35),
-                "humidity": random.randint(30, 90),
+                "condition": _RNG.choice(_WEATHER_CONDITIONS),
+                "temperature": _RNG.randint(-10, 35),
+                "humidity": _RNG.randint(30, 90),
                 "location": "London"
             }
         elif "news" in service_name:
-            headlines = [
-                "Tech stocks surge amid AI breakthrough",
-                "Climate summit reaches historic agreement",
-                "New medical discovery shows promise",
-                "Economic indicators point to growth"
-            ]
             return {
-                "headline": random.choice(headlines),
+                "headline": _RNG.choice(_HEADLINES),
                 "source": "Demo News",
                 "published_at": time.time()
             }
         elif "stock" in service_name:
             base_price = 150.0
-            change = random.uniform(-10, 10)
+            change = _RNG.uniform(-10, 10)
             return {
                 "price": round(base_price + change, 2),
                 "change": round(change, 2),
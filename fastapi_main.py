@@ -2,39 +2,28 @@
 FastAPI Application with Azure Application Insights and OpenTelemetry Integration
 """
 
+import asyncio
+import logging
 import os
 import uuid
 import time
+from contextlib import suppress
+from types import MappingProxyType
 from typing import Optional
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
-# OpenTelemetry imports
+# OpenTelemetry API only; the SDK, exporters and instrumentors are imported in setup_telemetry()
 from opentelemetry import trace, metrics
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
-from opentelemetry.propagate import set_global_textmap
-from opentelemetry.propagators.b3 import B3MultiFormat
-
-# Azure Monitor
-from azure.monitor.opentelemetry.exporter import AzureMonitorTraceExporter, AzureMonitorMetricExporter
 
 # Import our custom modules
 from services.chatbot_service import ChatbotService
 from services.external_service import ExternalAPIService
-from utils.telemetry_middleware import TelemetryMiddleware
-from utils.correlation_context import CorrelationContext
+from utils.telemetry_middleware import TelemetryMiddleware, MetricsMiddleware, new_request_id
+from utils.correlation_context import CorrelationContext, correlation_ctx_var
 from models.request_models import ChatbotRequest, ChatbotResponse
 
 # Configuration
@@ -43,11 +32,78 @@ AZURE_APPLICATION_INSIGHTS_CONNECTION_STRING = os.getenv(
     "InstrumentationKey=your-key-here;IngestionEndpoint=https://your-region.in.applicationinsights.azure.com/"
 )
 
+# Directory for offline retry storage of failed exports; unset keeps the exporter's own default
+AZURE_EXPORTER_STORAGE_DIRECTORY = os.getenv("APPLICATIONINSIGHTS_STORAGE_DIRECTORY")
+
+# Fraction of new traces to sample; requests that continue a trace follow the caller's decision
+TRACES_SAMPLE_RATIO = float(os.getenv("OTEL_TRACES_SAMPLER_ARG", "0.1"))
+
+# Server spans that are always sampled regardless of the ratio, as a comma-separated list of
+# "METHOD /path" names (e.g. "POST /chatbot_message"); empty by default so the ratio applies
+ALWAYS_SAMPLED_ROUTES = tuple(
+    route.strip() for route in os.getenv("ALWAYS_SAMPLED_ROUTES", "").split(",") if route.strip()
+)
+
+# Server spans that are never sampled: liveness probes carry no diagnostic value
+NEVER_SAMPLED_ROUTES = ("GET /healthcheck",)
+
+# Static parts of response bodies; handlers copy these and add the per-request fields
+_HEALTHY_TEMPLATE = MappingProxyType({"status": "healthy"})
+_ERROR_CONTENT = MappingProxyType({"error": "Internal server error", "request_id": None})
+
+# Seconds between background dependency checks; the healthcheck endpoint does not run them itself
+DEPENDENCY_CHECK_INTERVAL = float(os.getenv("DEPENDENCY_CHECK_INTERVAL_SECONDS", "30"))
+
+# Result of the most recent background dependency check; None until the first one completes
+_dependency_health: Optional[dict] = None
+
+logger = logging.getLogger(__name__)
+
 class TelemetrySetup:
     """Centralized telemetry configuration"""
     
+    @staticmethod
+    def check_span_export_pipeline() -> bool:
+        """Warn if the installed tracer provider exports spans synchronously; return True if batched"""
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        
+        # set_tracer_provider() keeps an already installed provider (e.g. from auto-instrumentation),
+        # so inspect the global one rather than the provider built in setup_telemetry()
+        provider = trace.get_tracer_provider()
+        if not isinstance(provider, TracerProvider):
+            # Not an SDK provider: its export pipeline cannot be inspected
+            return True
+        
+        processors = getattr(provider._active_span_processor, "_span_processors", ())
+        if any(isinstance(p, SimpleSpanProcessor) for p in processors):
+            logger.warning(
+                "SimpleSpanProcessor is registered on the tracer provider; every span end "
+                "blocks on export. Use BatchSpanProcessor for the chatbot service."
+            )
+            return False
+        return True
+    
     @staticmethod
     def setup_telemetry():
+        # Deferred so cold start does not pay for the SDK, exporter and Azure imports
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.sampling import ParentBased
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        from opentelemetry.instrumentation.requests import RequestsInstrumentor
+        from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+        from opentelemetry.propagate import set_global_textmap
+        from opentelemetry.propagators.b3 import B3MultiFormat
+        from azure.monitor.opentelemetry.exporter import (
+            ApplicationInsightsSampler,
+            AzureMonitorMetricExporter,
+            AzureMonitorTraceExporter
+        )
+        from utils.telemetry_sampling import RouteAwareSampler
+        
         # Create resource with service information
         resource = Resource.create({
             "service.name": "chatbot-api",
@@ -56,19 +112,36 @@ class TelemetrySetup:
         })
         
         # Setup tracing
-        trace_provider = TracerProvider(resource=resource)
+        trace_provider = TracerProvider(
+            resource=resource,
+            sampler=ParentBased(root=RouteAwareSampler(
+                # Stamps the sample rate on spans so Application Insights reports itemCount
+                ApplicationInsightsSampler(TRACES_SAMPLE_RATIO),
+                always_sample=ALWAYS_SAMPLED_ROUTES,
+                never_sample=NEVER_SAMPLED_ROUTES
+            ))
+        )
         trace.set_tracer_provider(trace_provider)
         
+        # Shared Azure Monitor exporter options; failed batches are persisted and retried
+        exporter_options = {"connection_string": AZURE_APPLICATION_INSIGHTS_CONNECTION_STRING}
+        if AZURE_EXPORTER_STORAGE_DIRECTORY:
+            exporter_options["storage_directory"] = AZURE_EXPORTER_STORAGE_DIRECTORY
+        
         # Azure Monitor trace exporter
-        azure_trace_exporter = AzureMonitorTraceExporter(
-            connection_string=AZURE_APPLICATION_INSIGHTS_CONNECTION_STRING
-        )
-        trace_provider.add_span_processor(BatchSpanProcessor(azure_trace_exporter))
+        azure_trace_exporter = AzureMonitorTraceExporter(**exporter_options)
+        # Batch sizing tuned for bursty chatbot traffic; each value can be overridden via OTEL_BSP_*
+        trace_provider.add_span_processor(BatchSpanProcessor(
+            azure_trace_exporter,
+            max_queue_size=int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "4096")),
+            schedule_delay_millis=int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "1000")),
+            max_export_batch_size=int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "256")),
+            export_timeout_millis=int(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "10000"))
+        ))
+        TelemetrySetup.check_span_export_pipeline()
         
         # Setup metrics
-        azure_metric_exporter = AzureMonitorMetricExporter(
-            connection_string=AZURE_APPLICATION_INSIGHTS_CONNECTION_STRING
-        )
+        azure_metric_exporter = AzureMonitorMetricExporter(**exporter_options)
         metric_reader = PeriodicExportingMetricReader(
             exporter=azure_metric_exporter,
             export_interval_millis=30000  # Export every 30 seconds
@@ -85,20 +158,40 @@ class TelemetrySetup:
         RequestsInstrumentor().instrument()
         HTTPXClientInstrumentor().instrument()
 
+async def poll_external_dependencies():
+    """Check external dependencies on a fixed interval and cache the result for /healthcheck"""
+    global _dependency_health
+    while True:
+        try:
+            _dependency_health = await external_service.check_external_dependencies(
+                CorrelationContext(request_id=new_request_id())
+            )
+        except Exception:
+            # Keep the last result and try again next interval
+            logger.exception("Background dependency check failed")
+        await asyncio.sleep(DEPENDENCY_CHECK_INTERVAL)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager"""
     # Startup
     TelemetrySetup.setup_telemetry()
+    dependency_checker = asyncio.create_task(poll_external_dependencies())
     yield
-    # Shutdown - cleanup if needed
+    # Shutdown - stop the dependency checker and release pooled HTTP connections
+    dependency_checker.cancel()
+    with suppress(asyncio.CancelledError):
+        await dependency_checker
+    await external_service.aclose()
+    await chatbot_service.external_service.aclose()
 
 # Create FastAPI application
 app = FastAPI(
     title="Chatbot API with Azure App Insights",
     description="Sample application demonstrating comprehensive telemetry",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Add telemetry middleware
@@ -131,65 +224,38 @@ dependency_duration = meter.create_histogram(
     unit="s"
 )
 
-@app.middleware("http")
-async def metrics_middleware(request: Request, call_next):
-    """Middleware to collect metrics"""
-    start_time = time.time()
-    
-    # Process request
-    response = await call_next(request)
-    
-    # Calculate duration
-    duration = time.time() - start_time
-    
-    # Record metrics
-    request_counter.add(1, {
-        "method": request.method,
-        "endpoint": str(request.url.path),
-        "status_code": str(response.status_code)
-    })
-    
-    request_duration.record(duration, {
-        "method": request.method,
-        "endpoint": str(request.url.path),
-        "status_code": str(response.status_code)
-    })
-    
-    return response
-
-def get_correlation_context(request: Request) -> CorrelationContext:
-    """Dependency to get correlation context"""
-    return request.state.correlation_context
+# Add metrics middleware (outermost, so it times the whole request)
+app.add_middleware(MetricsMiddleware, counter=request_counter, histogram=request_duration)
 
 @app.get("/healthcheck")
-async def healthcheck(correlation_ctx: CorrelationContext = Depends(get_correlation_context)):
+async def healthcheck():
     """Health check endpoint"""
+    correlation_ctx = correlation_ctx_var.get()
     with tracer.start_as_current_span("healthcheck_processing") as span:
-        span.set_attribute("request_id", correlation_ctx.request_id)
-        span.set_attribute("operation", "healthcheck")
-        
-        # Simulate some processing
-        await external_service.check_external_dependencies(correlation_ctx)
-        
+        span.set_attributes({
+            "operation": "healthcheck",
+            "request_id": correlation_ctx.request_id
+        })
         span.add_event("Health check completed successfully")
         
-        return {
-            "status": "healthy",
+        return ORJSONResponse({
+            **_HEALTHY_TEMPLATE,
             "request_id": correlation_ctx.request_id,
+            "dependencies": _dependency_health,
             "timestamp": time.time()
-        }
+        })
 
 @app.post("/chatbot_message", response_model=ChatbotResponse)
-async def chatbot_message(
-    request_data: ChatbotRequest,
-    correlation_ctx: CorrelationContext = Depends(get_correlation_context)
-):
+async def chatbot_message(request_data: ChatbotRequest):
     """Main chatbot endpoint"""
+    correlation_ctx = correlation_ctx_var.get()
     with tracer.start_as_current_span("chatbot_message_processing") as span:
         try:
+            rec = span.is_recording()
             span.set_attribute("request_id", correlation_ctx.request_id)
-            span.set_attribute("user_message_length", len(request_data.message))
-            span.set_attribute("user_id", request_data.user_id or "anonymous")
+            if rec:
+                span.set_attribute("user_message_length", len(request_data.message))
+                span.set_attribute("user_id", request_data.user_id or "anonymous")
             
             span.add_event("Processing chatbot message request")
             
@@ -200,8 +266,9 @@ async def chatbot_message(
                 correlation_ctx
             )
             
-            span.set_attribute("response_length", len(response.response))
-            span.add_event("Chatbot message processed successfully")
+            if rec:
+                span.set_attribute("response_length", len(response.response))
+                span.add_event("Chatbot message processed successfully")
             
             return response
             
@@ -227,17 +294,21 @@ async def global_exception_handler(request: Request, exc: Exception):
         span.set_status(trace.Status(trace.StatusCode.ERROR, str(exc)))
         span.add_event("Unhandled exception occurred")
         
-        return JSONResponse(
-            status_code=500,
-            content={
-                "error": "Internal server error",
-                "request_id": correlation_ctx.request_id if correlation_ctx else None
-            }
-        )
-
-# Instrument FastAPI with OpenTelemetry
-FastAPIInstrumentor.instrument_app(app)
+        content = {**_ERROR_CONTENT}
+        if correlation_ctx:
+            content["request_id"] = correlation_ctx.request_id
+        return ORJSONResponse(status_code=500, content=content)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Requires uvloop and httptools. Multiple workers need the app as an import string.
+    # In containers the equivalent is:
+    #   gunicorn fastapi_main:app -k uvicorn.workers.UvicornWorker -w $(nproc)
+    uvicorn.run(
+        "fastapi_main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
\ No newline at end of file
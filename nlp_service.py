@@ -3,11 +3,23 @@ NLP Service for intent recognition and entity extraction with telemetry
 """
 
 import asyncio
+import os
 import random
 import re
+import time
 from typing import Dict, List, Any
 from opentelemetry import trace, metrics
 from utils.correlation_context import CorrelationContext
+from utils.telemetry_common import metric_labels
+
+# Simulated model latency and score noise are demo-only; off unless NLP_SIMULATE_LATENCY=1
+SIMULATE_LATENCY = os.getenv("NLP_SIMULATE_LATENCY", "0") == "1"
+
+# Optional linear-time (DFA) engine for the entity scan: pip install google-re2
+try:
+    import re2 as _entity_regex
+except ImportError:
+    _entity_regex = re
 
 class NLPService:
     """Natural Language Processing service with comprehensive telemetry"""
@@ -27,6 +39,33 @@ class NLPService:
             "general": []  # fallback
         }
         
+        # Simple entity extraction patterns
+        self.entity_patterns = {
+            "location": r'\b(london|new york|paris|tokyo|sydney)\b',
+            "stock_symbol": r'\b([A-Z]{3,4})\b',
+            "number": r'\b(\d+\.?\d*)\b',
+            "date": r'\b(today|tomorrow|yesterday)\b'
+        }
+        
+        # All intent patterns compiled into one regex. Each pattern is a lookahead branch
+        # tried in declaration order, so the first intent (and pattern) that matches
+        # anywhere in the message wins, exactly as with one search per pattern.
+        self._intent_groups = {}
+        branches = []
+        for intent, patterns in self.intent_patterns.items():
+            for pattern in patterns:
+                group = f"p{len(self._intent_groups)}"
+                self._intent_groups[group] = (intent, pattern)
+                branches.append(f"(?=.*?(?P<{group}>{pattern}))")
+        self._intent_re = re.compile(r"\A(?:" + "|".join(branches) + ")", re.IGNORECASE | re.DOTALL)
+        
+        # All entity patterns compiled into one alternation scanned in a single pass.
+        # Case-insensitivity is an inline flag so the pattern compiles under re and re2 alike;
+        # it is still needed after lowercasing for the [A-Z] stock symbol pattern.
+        self._entity_re = _entity_regex.compile(
+            "(?i)" + "|".join(f"(?P<{entity_type}>{pattern})" for entity_type, pattern in self.entity_patterns.items())
+        )
+        
         # Create metrics
         self.intent_analysis_counter = self.meter.create_counter(
             name="nlp_intent_analysis_total",
@@ -49,29 +88,40 @@ class NLPService:
     async def analyze_intent(self, message: str, correlation_ctx: CorrelationContext) -> Dict[str, Any]:
         """Analyze message intent and extract entities"""
         with self.tracer.start_as_current_span("analyze_intent") as span:
-            import time
-            start_time = time.time()
-            
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.set_attribute("message_length", len(message))
-            span.set_attribute("service", "nlp")
+            start_ns = time.monotonic_ns()
             
-            span.add_event("Starting intent analysis", {
-                "message_preview": message[:100] + "..." if len(message) > 100 else message
+            span.set_attributes({
+                "service": "nlp",
+                "request_id": correlation_ctx.request_id,
+                "message_length": len(message)
             })
             
+            rec = span.is_recording()
+            if rec:
+                span.add_event("Starting intent analysis", {
+                    "message_preview": message[:100] + "..." if len(message) > 100 else message
+                })
+            
             try:
+                # The pipeline steps run in sequence in-process, so they are timed and
+                # reported as attributes of this span rather than as child spans
+                
                 # Step 1: Preprocess message
-                preprocessed = await self._preprocess_message(message, span, correlation_ctx)
+                step_start = time.monotonic_ns()
+                preprocessed = await self._preprocess_message(message)
+                preprocess_end = time.monotonic_ns()
                 
                 # Step 2: Classify intent
-                intent_result = await self._classify_intent(preprocessed, span, correlation_ctx)
+                intent_result = await self._classify_intent(preprocessed)
+                classify_end = time.monotonic_ns()
                 
                 # Step 3: Extract entities
-                entities = await self._extract_entities(preprocessed, span, correlation_ctx)
+                entities = await self._extract_entities(preprocessed)
+                extract_end = time.monotonic_ns()
                 
                 # Step 4: Calculate confidence
-                confidence = await self._calculate_confidence(intent_result, entities, span, correlation_ctx)
+                confidence = self._calculate_confidence(intent_result, entities)
+                confidence_end = time.monotonic_ns()
                 
                 # Prepare final result
                 analysis_result = {
@@ -83,43 +133,54 @@ class NLPService:
                 }
                 
                 # Record metrics
-                duration = time.time() - start_time
-                self.intent_analysis_duration.record(duration, {
-                    "intent": intent_result["intent"],
-                    "confidence_level": analysis_result["confidence_level"]
-                })
+                duration = (time.monotonic_ns() - start_ns) * 1e-9
+                intent = intent_result["intent"]
+                self.intent_analysis_duration.record(duration, metric_labels(
+                    "intent", intent,
+                    "confidence_level", analysis_result["confidence_level"]
+                ))
                 
-                self.intent_analysis_counter.add(1, {
-                    "intent": intent_result["intent"],
-                    "success": "true"
-                })
+                self.intent_analysis_counter.add(1, metric_labels(
+                    "intent", intent,
+                    "success", "true"
+                ))
                 
-                self.confidence_score_histogram.record(confidence, {
-                    "intent": intent_result["intent"]
-                })
+                self.confidence_score_histogram.record(confidence, metric_labels(
+                    "intent", intent
+                ))
                 
                 # Set span attributes
-                span.set_attribute("detected_intent", intent_result["intent"])
-                span.set_attribute("confidence_score", confidence)
-                span.set_attribute("entities_count", len(entities))
-                span.set_attribute("processing_time_ms", duration * 1000)
-                
-                span.add_event("Intent analysis completed", {
-                    "intent": intent_result["intent"],
-                    "confidence": confidence,
-                    "entities_found": len(entities),
-                    "processing_time_ms": duration * 1000
+                span.set_attributes({
+                    "detected_intent": intent_result["intent"],
+                    "confidence_score": confidence,
+                    "entities_count": len(entities),
+                    "processing_time_ms": duration * 1000,
+                    "nlp.preprocessed_length": len(preprocessed),
+                    "nlp.patterns_matched": len(intent_result["matched_patterns"]),
+                    "nlp.preprocess_ms": (preprocess_end - step_start) / 1e6,
+                    "nlp.classify_ms": (classify_end - preprocess_end) / 1e6,
+                    "nlp.extract_ms": (extract_end - classify_end) / 1e6,
+                    "nlp.confidence_ms": (confidence_end - extract_end) / 1e6
                 })
                 
+                if rec:
+                    span.add_event("Intent analysis completed", {
+                        "intent": intent_result["intent"],
+                        "confidence": confidence,
+                        "entities_found": len(entities),
+                        "entity_types": list(set(e["type"] for e in entities)),
+                        "processing_time_ms": duration * 1000
+                    })
+                
                 return analysis_result
                 
             except Exception as e:
-                duration = time.time() - start_time
+                duration = (time.monotonic_ns() - start_ns) * 1e-9
                 
-                self.intent_analysis_counter.add(1, {
-                    "intent": "error",
-                    "success": "false"
-                })
+                self.intent_analysis_counter.add(1, metric_labels(
+                    "intent", "error",
+                    "success", "false"
+                ))
                 
                 span.record_exception(e)
                 span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
@@ -129,138 +190,78 @@ class NLPService:
                 })
                 raise
     
-    async def _preprocess_message(self, message: str, parent_span, correlation_ctx: CorrelationContext) -> str:
+    async def _preprocess_message(self, message: str) -> str:
         """Preprocess the input message"""
-        with self.tracer.start_as_current_span("preprocess_message", parent=parent_span) as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.add_event("Starting message preprocessing")
-            
-            # Simulate preprocessing time
+        # Simulate preprocessing time
+        if SIMULATE_LATENCY:
             await asyncio.sleep(random.uniform(0.001, 0.005))
-            
-            # Basic preprocessing: lowercase, strip whitespace
-            preprocessed = message.lower().strip()
-            
-            # Remove extra whitespaces
-            preprocessed = re.sub(r'\s+', ' ', preprocessed)
-            
-            span.set_attribute("original_length", len(message))
-            span.set_attribute("preprocessed_length", len(preprocessed))
-            span.add_event("Message preprocessing completed")
-            
-            return preprocessed
+        
+        # Basic preprocessing: lowercase, strip whitespace
+        preprocessed = message.lower().strip()
+        
+        # Remove extra whitespaces
+        return re.sub(r'\s+', ' ', preprocessed)
     
-    async def _classify_intent(self, message: str, parent_span, correlation_ctx: CorrelationContext) -> Dict[str, Any]:
+    async def _classify_intent(self, message: str) -> Dict[str, Any]:
         """Classify the intent of the message"""
-        with self.tracer.start_as_current_span("classify_intent", parent=parent_span) as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.add_event("Starting intent classification")
-            
-            # Simulate ML model inference time
+        # Simulate ML model inference time
+        if SIMULATE_LATENCY:
             await asyncio.sleep(random.uniform(0.05, 0.15))
-            
-            # Simple rule-based classification
-            detected_intent = "general"
-            pattern_matches = []
-            
-            for intent, patterns in self.intent_patterns.items():
-                if intent == "general":
-                    continue
-                    
-                for pattern in patterns:
-                    if re.search(pattern, message, re.IGNORECASE):
-                        detected_intent = intent
-                        pattern_matches.append(pattern)
-                        break
-                
-                if detected_intent != "general":
-                    break
-            
-            result = {
-                "intent": detected_intent,
-                "matched_patterns": pattern_matches
-            }
-            
-            span.set_attribute("detected_intent", detected_intent)
-            span.set_attribute("patterns_matched", len(pattern_matches))
-            span.add_event("Intent classification completed", {
-                "intent": detected_intent,
-                "patterns_matched": len(pattern_matches)
-            })
-            
-            return result
+        
+        # Simple rule-based classification
+        detected_intent = "general"
+        pattern_matches = []
+        
+        match = self._intent_re.match(message)
+        if match:
+            detected_intent, pattern = self._intent_groups[match.lastgroup]
+            pattern_matches.append(pattern)
+        
+        return {
+            "intent": detected_intent,
+            "matched_patterns": pattern_matches
+        }
     
-    async def _extract_entities(self, message: str, parent_span, correlation_ctx: CorrelationContext) -> List[Dict[str, Any]]:
+    async def _extract_entities(self, message: str) -> List[Dict[str, Any]]:
         """Extract entities from the message"""
-        with self.tracer.start_as_current_span("extract_entities", parent=parent_span) as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.add_event("Starting entity extraction")
-            
-            # Simulate entity extraction processing time
+        # Simulate entity extraction processing time
+        if SIMULATE_LATENCY:
             await asyncio.sleep(random.uniform(0.02, 0.08))
-            
-            entities = []
-            
-            # Simple entity extraction patterns
-            entity_patterns = {
-                "location": r'\b(london|new york|paris|tokyo|sydney)\b',
-                "stock_symbol": r'\b([A-Z]{3,4})\b',
-                "number": r'\b(\d+\.?\d*)\b',
-                "date": r'\b(today|tomorrow|yesterday)\b'
-            }
-            
-            for entity_type, pattern in entity_patterns.items():
-                matches = re.finditer(pattern, message, re.IGNORECASE)
-                for match in matches:
-                    entities.append({
-                        "type": entity_type,
-                        "value": match.group(1),
-                        "start": match.start(),
-                        "end": match.end(),
-                        "confidence": random.uniform(0.7, 1.0)
-                    })
-            
-            span.set_attribute("entities_found", len(entities))
-            span.add_event("Entity extraction completed", {
-                "entities_count": len(entities),
-                "entity_types": list(set(e["type"] for e in entities))
+        
+        entities = []
+        
+        for match in self._entity_re.finditer(message):
+            entity_type = match.lastgroup
+            entities.append({
+                "type": entity_type,
+                "value": match.group(entity_type),
+                "start": match.start(),
+                "end": match.end(),
+                "confidence": random.uniform(0.7, 1.0) if SIMULATE_LATENCY else 0.85
             })
-            
-            return entities
+        
+        return entities
     
-    async def _calculate_confidence(
-        self, 
-        intent_result: Dict[str, Any], 
-        entities: List[Dict[str, Any]], 
-        parent_span,
-        correlation_ctx: CorrelationContext
-    ) -> float:
+    def _calculate_confidence(self, intent_result: Dict[str, Any], entities: List[Dict[str, Any]]) -> float:
         """Calculate overall confidence score"""
-        with self.tracer.start_as_current_span("calculate_confidence", parent=parent_span) as span:
-            span.set_attribute("request_id", correlation_ctx.request_id)
-            span.add_event("Calculating confidence score")
-            
-            # Simple confidence calculation
-            base_confidence = 0.5
-            
-            # Boost confidence if patterns matched
-            if intent_result.get("matched_patterns"):
-                base_confidence += 0.3
-            
-            # Boost confidence based on entities found
-            if entities:
-                entity_boost = min(0.2, len(entities) * 0.05)
-                base_confidence += entity_boost
-            
-            # Add some randomness to simulate ML model uncertainty
-            final_confidence = min(1.0, base_confidence + random.uniform(-0.1, 0.1))
-            
-            span.set_attribute("calculated_confidence", final_confidence)
-            span.add_event("Confidence calculation completed", {
-                "confidence_score": final_confidence
-            })
-            
-            return round(final_confidence, 3)
+        # Simple confidence calculation
+        base_confidence = 0.5
+        
+        # Boost confidence if patterns matched
+        if intent_result.get("matched_patterns"):
+            base_confidence += 0.3
+        
+        # Boost confidence based on entities found
+        if entities:
+            entity_boost = min(0.2, len(entities) * 0.05)
+            base_confidence += entity_boost
+        
+        # Add some randomness to simulate ML model uncertainty
+        if SIMULATE_LATENCY:
+            base_confidence += random.uniform(-0.1, 0.1)
+        final_confidence = min(1.0, base_confidence)
+        
+        return round(final_confidence, 3)
     
     def _get_confidence_level(self, confidence: float) -> str:
         """Convert confidence score to level"""
@@ -0,0 +1,22 @@
+"""
+Telemetry helpers and settings shared by the services
+"""
+
+import os
+from opentelemetry import trace
+
+# Response size attributes are opt-in; they are only item counts, not byte sizes
+TRACE_RESPONSE_SIZE = os.getenv("TRACE_RESPONSE_SIZE") == "1"
+
+# Shared error status; the exception details are on the span via record_exception
+ERROR_STATUS = trace.Status(trace.StatusCode.ERROR)
+
+# Interned metric label dicts, keyed by their flattened (key, value, ...) tuple
+_metric_labels_cache: dict[tuple, dict] = {}
+
+def metric_labels(*kv) -> dict:
+    """Return a shared label dict for the given alternating keys and values"""
+    labels = _metric_labels_cache.get(kv)
+    if labels is None:
+        labels = _metric_labels_cache[kv] = dict(zip(kv[::2], kv[1::2]))
+    return labels
@@ -2,92 +2,174 @@
 Custom middleware for handling correlation context and telemetry
 """
 
-import uuid
+import itertools
+import os
+import re
 import time
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
+from functools import lru_cache
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from opentelemetry import trace
-from utils.correlation_context import CorrelationContext
+from opentelemetry.propagate import extract
+from utils.correlation_context import CorrelationContext, correlation_ctx_var
+from utils.telemetry_common import metric_labels
 
-class TelemetryMiddleware(BaseHTTPMiddleware):
-    """Middleware to handle correlation context and request tracing"""
+# Generated request ids are "<process prefix>-<hex counter>", unique per process start
+def _new_id_source():
+    return f"{os.getpid():x}{time.time_ns():x}", itertools.count()
+
+_id_prefix, _id_counter = _new_id_source()
+
+def _reset_id_source():
+    global _id_prefix, _id_counter
+    _id_prefix, _id_counter = _new_id_source()
+
+# Forked workers (e.g. gunicorn --preload) must not reuse the parent's prefix; fork is Unix-only
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_id_source)
+
+def new_request_id() -> str:
+    """Generate a process-unique request id without touching the OS random source"""
+    return f"{_id_prefix}-{next(_id_counter):x}"
+
+# Path segments that are identifiers (numbers, UUIDs, long hex strings)
+_ID_SEGMENT = re.compile(r"/(?:\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[0-9a-fA-F]{16,})(?=/|$)")
+
+@lru_cache(maxsize=2048)
+def template_of(path: str) -> str:
+    """Collapse identifier path segments so /users/123 becomes /users/{id}"""
+    return _ID_SEGMENT.sub("/{id}", path)
+
+def _hostname(host: str) -> str:
+    """Strip the port (and IPv6 brackets) from a host[:port] value"""
+    if host.startswith("["):
+        return host[1:host.find("]")]
+    return host.partition(":")[0]
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def _request_host(scope: Scope, headers: dict, scheme: str) -> str:
+    """Host header value, falling back to the server address like Starlette's URL does"""
+    host = headers.get(b"host")
+    if host:
+        return host.decode("latin-1")
+    server = scope.get("server")
+    if not server:
+        return ""
+    server_host, server_port = server
+    if server_port is None or server_port == _DEFAULT_PORTS.get(scheme):
+        return server_host
+    return f"{server_host}:{server_port}"
+
+class TelemetryMiddleware:
+    """Pure ASGI middleware to handle correlation context and request tracing"""
     
-    def __init__(self, app):
-        super().__init__(app)
+    def __init__(self, app: ASGIApp):
+        self.app = app
         self.tracer = trace.get_tracer(__name__)
     
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """Process request with correlation context"""
-        start_time = time.time()
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        start_ns = time.monotonic_ns()
+        method = scope["method"]
+        path = scope["path"]
+        headers = dict(scope["headers"])
         
         # Extract or generate request_id
-        request_id = request.headers.get("x-request-id") or request.headers.get("request-id")
-        if not request_id:
-            request_id = str(uuid.uuid4())
+        raw_request_id = headers.get(b"x-request-id") or headers.get(b"request-id")
+        if raw_request_id:
+            request_id = raw_request_id.decode("latin-1")
+        else:
+            request_id = new_request_id()
         
         # Create correlation context
         correlation_ctx = CorrelationContext(
             request_id=request_id,
-            operation_id=trace.get_current_span().get_span_context().trace_id,
-            start_time=start_time
+            start_time=start_ns
         )
         
-        # Store in request state
-        request.state.correlation_context = correlation_ctx
+        # Expose to handlers via the context var. Also keep it in request state for the
+        # exception handler, which runs outside this middleware after the var is reset.
+        scope.setdefault("state", {})["correlation_context"] = correlation_ctx
+        
+        request_id_header = (b"x-request-id", request_id.encode("latin-1"))
+        status_code = None
+        
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # Set request_id in response headers for client tracking, replacing any
+                # x-request-id the handler already set
+                message["headers"] = [
+                    *(h for h in message.get("headers", ()) if h[0].lower() != b"x-request-id"),
+                    request_id_header
+                ]
+            await send(message)
+        
+        # Continue the caller's trace, if any, using the globally configured propagator
+        parent_ctx = extract({k.decode("latin-1"): v.decode("latin-1") for k, v in headers.items()})
         
         # Start a span for the entire request
         with self.tracer.start_as_current_span(
-            f"{request.method} {request.url.path}",
+            f"{method} {path}",
+            context=parent_ctx,
             kind=trace.SpanKind.SERVER
         ) as span:
-            # Set span attributes
-            span.set_attribute("http.method", request.method)
-            span.set_attribute("http.url", str(request.url))
-            span.set_attribute("http.scheme", request.url.scheme)
-            span.set_attribute("http.host", request.url.hostname or "")
-            span.set_attribute("http.target", request.url.path)
+            # Set span attributes; URL reconstruction and header decoding only when sampled
+            rec = span.is_recording()
+            span.set_attribute("http.method", method)
+            span.set_attribute("http.target", path)
             span.set_attribute("request_id", request_id)
-            span.set_attribute("user_agent", request.headers.get("user-agent", ""))
-            
-            # Add request start event
-            span.add_event("Request started", {
-                "request_id": request_id,
-                "method": request.method,
-                "path": request.url.path
-            })
+            if rec:
+                scheme = scope.get("scheme", "http")
+                host = _request_host(scope, headers, scheme)
+                query = scope.get("query_string", b"").decode("latin-1")
+                span.set_attribute("http.url", f"{scheme}://{host}{scope.get('root_path', '')}{path}" + (f"?{query}" if query else ""))
+                span.set_attribute("http.scheme", scheme)
+                span.set_attribute("http.host", _hostname(host))
+                span.set_attribute("user_agent", headers.get(b"user-agent", b"").decode("latin-1"))
+                
+                # Add request start event
+                span.add_event("Request started", {
+                    "request_id": request_id,
+                    "method": method,
+                    "path": path
+                })
             
+            ctx_token = correlation_ctx_var.set(correlation_ctx)
             try:
                 # Process the request
-                response = await call_next(request)
+                await self.app(scope, receive, send_wrapper)
                 
                 # Calculate total request duration
-                duration = time.time() - start_time
+                duration = (time.monotonic_ns() - start_ns) / 1e9
                 
-                # Set response attributes
-                span.set_attribute("http.status_code", response.status_code)
-                span.set_attribute("request.duration_ms", duration * 1000)
+                if status_code is not None:
+                    # Set response attributes
+                    span.set_attribute("http.status_code", status_code)
+                    
+                    # Set span status based on response
+                    if status_code >= 400:
+                        span.set_status(trace.Status(
+                            trace.StatusCode.ERROR,
+                            f"HTTP {status_code}"
+                        ))
+                    else:
+                        span.set_status(trace.Status(trace.StatusCode.OK))
                 
-                # Set span status based on response
-                if response.status_code >= 400:
-                    span.set_status(trace.Status(
-                        trace.StatusCode.ERROR,
-                        f"HTTP {response.status_code}"
-                    ))
-                else:
-                    span.set_status(trace.Status(trace.StatusCode.OK))
+                span.set_attribute("request.duration_ms", duration * 1000)
                 
                 # Add completion event
-                span.add_event("Request completed", {
-                    "status_code": response.status_code,
-                    "duration_ms": duration * 1000
-                })
-                
-                # Add request_id to response headers for client tracking
-                response.headers["x-request-id"] = request_id
-                
-                return response
-                
+                if rec:
+                    span.add_event("Request completed", {
+                        "status_code": status_code or 0,
+                        "duration_ms": duration * 1000
+                    })
+            
             except Exception as e:
                 # Record exception in span
                 span.record_exception(e)
@@ -96,4 +178,49 @@ class TelemetryMiddleware(BaseHTTPMiddleware):
                     "exception_type": type(e).__name__,
                     "exception_message": str(e)
                 })
-                raise
\ No newline at end of file
+                raise
+            finally:
+                correlation_ctx_var.reset(ctx_token)
+
+class MetricsMiddleware:
+    """Pure ASGI middleware to record HTTP request count and duration metrics"""
+    
+    def __init__(self, app: ASGIApp, counter, histogram):
+        self.app = app
+        self.counter = counter
+        self.histogram = histogram
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Time the request and record metrics once the app has responded"""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        start_time = time.perf_counter()
+        method = scope["method"]
+        path = scope["path"]
+        status_code = 500
+        
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        try:
+            # Process request
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Calculate duration; requests that raised before responding count as 500
+            duration = time.perf_counter() - start_time
+            
+            # Record metrics against the matched route template when routing set one
+            route = scope.get("route")
+            endpoint = route.path if route is not None else template_of(path)
+            attrs = metric_labels(
+                "method", method,
+                "endpoint", endpoint,
+                "status_code", str(status_code)
+            )
+            self.counter.add(1, attrs)
+            self.histogram.record(duration, attrs)
\ No newline at end of file
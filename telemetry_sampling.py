@@ -0,0 +1,49 @@
+"""
+Trace sampling policy for the chatbot API
+"""
+
+from typing import Optional, Sequence
+from opentelemetry import trace
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace.sampling import Decision, Sampler, SamplingResult
+from opentelemetry.trace import Link, SpanKind
+from opentelemetry.util.types import Attributes
+
+class RouteAwareSampler(Sampler):
+    """Root sampler that always samples or always drops selected server spans and delegates the rest"""
+    
+    def __init__(self, delegate: Sampler, always_sample: Sequence[str] = (), never_sample: Sequence[str] = ()):
+        self._delegate = delegate
+        # Server span names, i.e. "<METHOD> <path>" as created by TelemetryMiddleware
+        self._always_sample = frozenset(always_sample)
+        self._never_sample = frozenset(never_sample)
+    
+    def should_sample(
+        self,
+        parent_context: Optional[Context],
+        trace_id: int,
+        name: str,
+        kind: Optional[SpanKind] = None,
+        attributes: Attributes = None,
+        links: Optional[Sequence[Link]] = None,
+        trace_state: Optional[trace.TraceState] = None
+    ) -> SamplingResult:
+        """Force-sample or drop the configured server spans, otherwise defer to the delegate"""
+        if kind == SpanKind.SERVER:
+            if name in self._never_sample:
+                return SamplingResult(Decision.DROP)
+            
+            if name in self._always_sample:
+                parent_span_context = trace.get_current_span(parent_context).get_span_context()
+                return SamplingResult(
+                    Decision.RECORD_AND_SAMPLE,
+                    attributes,
+                    parent_span_context.trace_state
+                )
+        
+        return self._delegate.should_sample(
+            parent_context, trace_id, name, kind, attributes, links, trace_state
+        )
+    
+    def get_description(self) -> str:
+        return f"RouteAwareSampler{{{self._delegate.get_description()}}}"